@@ -16,16 +16,19 @@ Open:
   http://localhost:8787
 """
 
+import hashlib
+import json
 import os
 import traceback
 import uuid
 from pathlib import Path
 from typing import Dict, List
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+import anyio.to_thread
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from openai import OpenAI
+from openai import AsyncOpenAI
 from pydantic import BaseModel
 
 # Import storage module
@@ -45,103 +48,136 @@ SYSTEM_PROMPT = os.environ.get(
 )
 LOG_OPENAI = os.environ.get("TREECHAT_LOG_OPENAI", "1") != "0"
 
-client = OpenAI()
+client = AsyncOpenAI()
 
 # ----------------------------
 # OpenAI call
 # ----------------------------
-def call_chatgpt(messages: List[Dict[str, str]]) -> str:
+async def stream_chatgpt(messages: List[Dict[str, str]]):
     """
-    Uses Responses API via official SDK.
+    Uses Chat Completions streaming via official SDK; yields text deltas
+    as they arrive so the client sees tokens at TTFT instead of waiting
+    for the full completion.
     """
     request_id = uuid.uuid4().hex
     if LOG_OPENAI:
-        st.log_openai_event(
+        await anyio.to_thread.run_sync(
+            st.log_openai_event,
             {
                 "type": "openai_request",
                 "request_id": request_id,
                 "model": MODEL,
                 "messages": messages,
-            }
+            },
         )
 
+    parts: List[str] = []
     try:
-        resp = client.chat.completions.create(
+        stream = await client.chat.completions.create(
             model=MODEL,
             messages=messages,
+            stream=True,
         )
-        assistant_text = resp.choices[0].message.content.strip()
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
 
         if LOG_OPENAI:
-            dump = resp.model_dump() if hasattr(resp, "model_dump") else None
-            st.log_openai_event(
+            await anyio.to_thread.run_sync(
+                st.log_openai_event,
                 {
                     "type": "openai_response",
                     "request_id": request_id,
                     "model": MODEL,
-                    "assistant_text": assistant_text,
-                    "response": dump,
-                }
+                    "assistant_text": "".join(parts).strip(),
+                },
             )
-
-        return assistant_text
     except Exception as e:
         if LOG_OPENAI:
-            st.log_openai_event(
+            await anyio.to_thread.run_sync(
+                st.log_openai_event,
                 {
                     "type": "openai_error",
                     "request_id": request_id,
                     "model": MODEL,
                     "error": str(e),
                     "traceback": traceback.format_exc(),
-                }
+                },
             )
         raise
 
 # ----------------------------
 # FastAPI App
 # ----------------------------
-app = FastAPI()
+# orjson serializes the branch/message payloads several times faster than
+# the stdlib encoder — noticeable for api_branch on long transcripts.
+app = FastAPI(default_response_class=ORJSONResponse)
 
 STATIC_DIR = Path(__file__).parent / "static"
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
-@app.get("/", response_class=HTMLResponse)
-def index():
-    return HTMLResponse((STATIC_DIR / "index.html").read_text(encoding="utf-8"))
+# Read once at startup; serving the UI is then a pointer return, and the
+# ETag lets repeat visits short-circuit to a 304.
+INDEX_HTML = (STATIC_DIR / "index.html").read_bytes()
+INDEX_ETAG = hashlib.md5(INDEX_HTML).hexdigest()
+
+@app.get("/")
+def index(request: Request):
+    if request.headers.get("if-none-match") == INDEX_ETAG:
+        return Response(status_code=304, headers={"ETag": INDEX_ETAG})
+    return Response(
+        INDEX_HTML,
+        media_type="text/html",
+        headers={"ETag": INDEX_ETAG, "Cache-Control": "no-cache"},
+    )
 
 class CreateRootReq(BaseModel):
     title: str = "Root"
 
 @app.post("/api/create_root")
-def api_create_root(req: CreateRootReq):
-    meta = st.create_branch(req.title, parent_branch_id="", fork_from_message=None)
+async def api_create_root(req: CreateRootReq):
+    meta = await anyio.to_thread.run_sync(st.create_branch, req.title, "", None)
     return meta
 
 @app.get("/api/branches")
-def api_branches():
-    return st.list_branches()
+async def api_branches():
+    return await anyio.to_thread.run_sync(st.list_branches)
 
 @app.get("/api/branch/{branch_id}")
-def api_branch(branch_id: str):
-    return st.get_branch(branch_id)
+async def api_branch(branch_id: str):
+    return await anyio.to_thread.run_sync(st.get_branch, branch_id)
 
 class ReplyReq(BaseModel):
     branch_id: str
     user_text: str
 
 @app.post("/api/reply")
-def api_reply(req: ReplyReq):
+async def api_reply(req: ReplyReq):
     # Append user message
-    st.append_message(req.branch_id, "user", req.user_text)
-
-    # Build context and call model
-    ctx = st.build_context(req.branch_id)
-    assistant_text = call_chatgpt(ctx)
+    await anyio.to_thread.run_sync(st.append_message, req.branch_id, "user", req.user_text)
+
+    # Build context and call model; the await lets other requests (and
+    # their disk I/O) run while this one waits on the API
+    ctx = await anyio.to_thread.run_sync(st.build_context, req.branch_id)
+
+    async def event_stream():
+        parts: List[str] = []
+        try:
+            async for delta in stream_chatgpt(ctx):
+                parts.append(delta)
+                yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+
+            # Persist the assistant message once the stream completes
+            assistant = await anyio.to_thread.run_sync(
+                st.append_message, req.branch_id, "assistant", "".join(parts).strip()
+            )
+            yield f"data: {json.dumps({'done': True, 'assistant': assistant}, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
 
-    # Append assistant message
-    assistant = st.append_message(req.branch_id, "assistant", assistant_text)
-    return {"assistant": assistant}
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 class ForkReq(BaseModel):
     from_branch_id: str
@@ -149,15 +185,13 @@ class ForkReq(BaseModel):
     title: str
 
 @app.post("/api/fork")
-def api_fork(req: ForkReq):
-    meta = st.create_branch(
-        req.title, 
-        parent_branch_id=req.from_branch_id, 
-        fork_from_message=req.from_message
+async def api_fork(req: ForkReq):
+    meta = await anyio.to_thread.run_sync(
+        st.create_branch, req.title, req.from_branch_id, req.from_message
     )
     # Optional breadcrumb in new branch
     breadcrumb = f"Forked from [[{req.from_branch_id}]] at M{req.from_message}."
-    st.append_message(meta["branch_id"], "user", breadcrumb)
+    await anyio.to_thread.run_sync(st.append_message, meta["branch_id"], "user", breadcrumb)
     return meta
 
 class DeleteReq(BaseModel):
@@ -165,6 +199,6 @@ class DeleteReq(BaseModel):
     delete_artifacts: bool = True
 
 @app.post("/api/delete_branch")
-def api_delete_branch(req: DeleteReq):
-    st.delete_branch(req.branch_id, delete_artifacts=req.delete_artifacts)
+async def api_delete_branch(req: DeleteReq):
+    await anyio.to_thread.run_sync(st.delete_branch, req.branch_id, req.delete_artifacts)
     return {"ok": True}
@@ -115,11 +115,63 @@ async function createRoot(){
   await openBranch(meta.branch_id);
 }
 
+function appendLiveMessage(label, content){
+  const chat = el("chat");
+  const div = document.createElement("div");
+  div.className = "msg";
+  div.innerHTML = `
+    <div class="msgRole">${escapeHtml(label)}</div>
+    <div class="msgContent markdown-body"></div>
+  `;
+  div.querySelector(".msgContent").innerText = content;
+  chat.appendChild(div);
+  chat.scrollTop = chat.scrollHeight;
+  return div.querySelector(".msgContent");
+}
+
 async function sendReply(){
   const text = (el("userText").value || "").trim();
   if(!text) return;
   el("userText").value = "";
-  await api("/api/reply", "POST", {branch_id: activeBranchId, user_text: text});
+
+  // The reply endpoint streams SSE frames; render deltas as they arrive.
+  appendLiveMessage("user", text);
+  const live = appendLiveMessage("assistant", "…");
+
+  const res = await fetch("/api/reply", {
+    method: "POST",
+    headers: {"Content-Type":"application/json"},
+    body: JSON.stringify({branch_id: activeBranchId, user_text: text})
+  });
+  if(!res.ok){
+    alert(await res.text());
+    await openBranch(activeBranchId);
+    return;
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "", streamed = "";
+  while(true){
+    const {done, value} = await reader.read();
+    if(done) break;
+    buf += decoder.decode(value, {stream: true});
+    let idx;
+    while((idx = buf.indexOf("\n\n")) !== -1){
+      const frame = buf.slice(0, idx);
+      buf = buf.slice(idx + 2);
+      if(!frame.startsWith("data: ")) continue;
+      const evt = JSON.parse(frame.slice(6));
+      if(evt.delta){
+        streamed += evt.delta;
+        live.innerText = streamed;
+        el("chat").scrollTop = el("chat").scrollHeight;
+      }
+      if(evt.error){
+        alert(evt.error);
+      }
+    }
+  }
   await openBranch(activeBranchId);
 }
 
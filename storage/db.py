@@ -0,0 +1,217 @@
+"""SQLite mirror of the branch files.
+
+The markdown notes under TreeChat/branches/ stay the source of truth (they
+must remain valid, hand-editable Obsidian notes), but parsing them is the
+expensive part of every request. This module keeps a write-through mirror in
+TreeChat/treechat.db: one row per branch with its file stat and metadata,
+plus one row per message. A branch whose stored (mtime_ns, size) still
+matches the file on disk can be served straight from indexed rows — no file
+read, no frontmatter parse, no header scan — including across restarts.
+
+The mirror is strictly an optimization: every helper is best-effort, and a
+missing or stale row just sends the caller back to the markdown file.
+"""
+
+import json
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS branches (
+    branch_id TEXT PRIMARY KEY,
+    parent_branch_id TEXT NOT NULL DEFAULT '',
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    meta TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_branches_parent ON branches(parent_branch_id);
+CREATE TABLE IF NOT EXISTS messages (
+    branch_id TEXT NOT NULL,
+    m INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (branch_id, m)
+);
+"""
+
+# sqlite3 connections are not safe for unsynchronized cross-thread use, and
+# FastAPI runs sync handlers in a threadpool.
+_LOCK = threading.Lock()
+
+
+def connect(db_path: Path) -> Optional[sqlite3.Connection]:
+    """Open (and initialize) the mirror database; None if SQLite fails."""
+    try:
+        conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        return conn
+    except sqlite3.Error:
+        return None
+
+
+def replace_branch(
+    conn: Optional[sqlite3.Connection],
+    branch_id: str,
+    mtime_ns: int,
+    size: int,
+    meta: Dict[str, Any],
+    messages: List[Dict[str, Any]],
+) -> None:
+    """Replace a branch row and all its message rows from a fresh parse."""
+    if conn is None:
+        return
+    try:
+        with _LOCK:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT OR REPLACE INTO branches VALUES (?, ?, ?, ?, ?)",
+                (
+                    branch_id,
+                    str(meta.get("parent_branch_id") or ""),
+                    mtime_ns,
+                    size,
+                    json.dumps(meta, ensure_ascii=False),
+                ),
+            )
+            conn.execute("DELETE FROM messages WHERE branch_id = ?", (branch_id,))
+            conn.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?)",
+                [(branch_id, m["m"], m["role"], m["content"]) for m in messages],
+            )
+            conn.execute("COMMIT")
+    except sqlite3.Error:
+        pass
+
+
+def append_message(
+    conn: Optional[sqlite3.Connection],
+    branch_id: str,
+    message: Dict[str, Any],
+    mtime_ns: int,
+    size: int,
+    meta: Dict[str, Any],
+) -> None:
+    """Record a single appended message without rewriting the other rows."""
+    if conn is None:
+        return
+    try:
+        with _LOCK:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                (branch_id, message["m"], message["role"], message["content"]),
+            )
+            conn.execute(
+                "UPDATE branches SET mtime_ns = ?, size = ?, meta = ? WHERE branch_id = ?",
+                (mtime_ns, size, json.dumps(meta, ensure_ascii=False), branch_id),
+            )
+            conn.execute("COMMIT")
+    except sqlite3.Error:
+        pass
+
+
+def touch_branch(
+    conn: Optional[sqlite3.Connection],
+    branch_id: str,
+    mtime_ns: int,
+    size: int,
+    meta: Dict[str, Any],
+) -> None:
+    """Refresh a branch row's stat and metadata without touching messages."""
+    if conn is None:
+        return
+    try:
+        with _LOCK:
+            conn.execute(
+                "UPDATE branches SET mtime_ns = ?, size = ?, meta = ? WHERE branch_id = ?",
+                (mtime_ns, size, json.dumps(meta, ensure_ascii=False), branch_id),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def get_branch(
+    conn: Optional[sqlite3.Connection], branch_id: str
+) -> Optional[Tuple[int, int, Dict[str, Any]]]:
+    """Return (mtime_ns, size, meta) for a mirrored branch, or None."""
+    if conn is None:
+        return None
+    try:
+        with _LOCK:
+            row = conn.execute(
+                "SELECT mtime_ns, size, meta FROM branches WHERE branch_id = ?",
+                (branch_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+    except (sqlite3.Error, ValueError):
+        return None
+
+
+def get_messages(
+    conn: Optional[sqlite3.Connection], branch_id: str
+) -> Optional[List[Dict[str, Any]]]:
+    """Return the mirrored messages of a branch ordered by m, or None."""
+    if conn is None:
+        return None
+    try:
+        with _LOCK:
+            rows = conn.execute(
+                "SELECT m, role, content FROM messages WHERE branch_id = ? ORDER BY m",
+                (branch_id,),
+            ).fetchall()
+        return [{"m": r[0], "role": sys.intern(r[1]), "content": r[2]} for r in rows]
+    except sqlite3.Error:
+        return None
+
+
+def children(
+    conn: Optional[sqlite3.Connection], parent_branch_id: str
+) -> Optional[List[str]]:
+    """Return the branch_ids forked from a branch, or None if unavailable."""
+    if conn is None:
+        return None
+    try:
+        with _LOCK:
+            rows = conn.execute(
+                "SELECT branch_id FROM branches WHERE parent_branch_id = ? ORDER BY branch_id",
+                (parent_branch_id,),
+            ).fetchall()
+        return [r[0] for r in rows]
+    except sqlite3.Error:
+        return None
+
+
+def all_branches(
+    conn: Optional[sqlite3.Connection],
+) -> Optional[Dict[str, Tuple[int, int, Dict[str, Any]]]]:
+    """Return {branch_id: (mtime_ns, size, meta)} for every mirrored branch."""
+    if conn is None:
+        return None
+    try:
+        with _LOCK:
+            rows = conn.execute(
+                "SELECT branch_id, mtime_ns, size, meta FROM branches"
+            ).fetchall()
+        return {r[0]: (r[1], r[2], json.loads(r[3])) for r in rows}
+    except (sqlite3.Error, ValueError):
+        return None
+
+
+def delete_branch(conn: Optional[sqlite3.Connection], branch_id: str) -> None:
+    """Drop a branch and its messages from the mirror."""
+    if conn is None:
+        return
+    try:
+        with _LOCK:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM messages WHERE branch_id = ?", (branch_id,))
+            conn.execute("DELETE FROM branches WHERE branch_id = ?", (branch_id,))
+            conn.execute("COMMIT")
+    except sqlite3.Error:
+        pass
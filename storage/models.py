@@ -4,18 +4,33 @@ This module contains the core data models and storage operations for the TreeCha
 It handles all file I/O and data persistence logic.
 """
 
+import atexit
 import os
 import json
 import re
+import shutil
+import sys
+import threading
 import traceback
 import uuid
+from bisect import bisect_right
+from collections import deque
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 import yaml
 from fastapi import HTTPException
 
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a size heuristic
+    tiktoken = None
+
+from . import db as _db
+
 # ----------------------------
 # Config
 # ----------------------------
@@ -33,13 +48,73 @@ BRANCH_DIR.mkdir(parents=True, exist_ok=True)
 ARTIFACT_DIR.mkdir(parents=True, exist_ok=True)
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
+# SQLite mirror of the branch files (markdown stays the source of truth).
+_DB = _db.connect(ROOT / "treechat.db")
+
 SYSTEM_PROMPT = os.environ.get(
     "TREECHAT_SYSTEM_PROMPT",
     "You are a helpful assistant. Be concise, clear, and correct.",
 )
 
+# Single shared system message, prepended to every context by reference.
+# It is never mutated, so one dict serves all calls — and keeps the prompt
+# prefix byte-identical between replies.
+SYSTEM_DICT: Dict[str, str] = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Pinned context prefix: every built context starts with these messages
+# (by reference). A tuple so it can never be extended or reordered in place.
+_SYSTEM_PREFIX: Tuple[Dict[str, str], ...] = (SYSTEM_DICT,)
+
+MODEL = os.environ.get("TREECHAT_MODEL", "gpt-4o-mini")
+MAX_CONTEXT_TOKENS = int(os.environ.get("TREECHAT_MAX_CONTEXT_TOKENS", "100000"))
+
+# The encoding is loaded lazily on first use: encoding_for_model() fetches
+# the BPE file over the network when it is not cached locally, and a fetch
+# failure must never prevent the app from starting.
+_ENC: Optional[Any] = None
+_ENC_LOADED = False
+
+
+def _get_encoding() -> Optional[Any]:
+    global _ENC, _ENC_LOADED
+    if not _ENC_LOADED:
+        _ENC_LOADED = True
+        if tiktoken is not None:
+            try:
+                _ENC = tiktoken.encoding_for_model(MODEL)
+            except Exception:
+                try:
+                    _ENC = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _ENC = None
+    return _ENC
+
+
+@lru_cache(maxsize=4096)
+def _token_count(content: str) -> int:
+    """Token count of a message body, cached per content string."""
+    enc = _get_encoding()
+    if enc is not None:
+        return len(enc.encode(content))
+    # Rough heuristic (~4 chars/token) when tiktoken is unavailable.
+    return len(content) // 4 + 1
+
 MSG_HEADER_RE = re.compile(r"^##\s+M(\d+)\s+\((User|Assistant)\)\s*$", re.M)
 
+# Interned once so every parsed message shares the same role string object.
+_ROLE_USER = sys.intern("user")
+_ROLE_ASSISTANT = sys.intern("assistant")
+
+# Cheap client-input check before any filesystem access: rejects path
+# traversal and absurd ids without a syscall. Deliberately looser than the
+# ids create_branch generates — hand-created notes like `b_root` are valid.
+_BRANCH_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+
+def _require_valid_branch_id(branch_id: str) -> None:
+    if not _BRANCH_ID_RE.match(branch_id or ""):
+        raise HTTPException(400, f"Invalid branch_id: {branch_id!r}")
+
 
 def log_openai_event(event: Dict[str, Any]) -> None:
     try:
@@ -67,22 +142,156 @@ def log_openai_event(event: Dict[str, Any]) -> None:
 # ----------------------------
 # File I/O Helpers
 # ----------------------------
+# Parsed-file cache: path -> (mtime_ns, size, meta, body, messages).
+# Branch files only change through _write_branch_file or external edits
+# (Obsidian), so a stat() comparison is enough to know a cached parse is
+# still valid. This turns repeated reads (list/get/context on the same
+# branches) into a single syscall instead of read + YAML parse + regex scan.
+_CACHE: Dict[Path, Tuple[int, int, Dict[str, Any], str, List[Dict[str, Any]]]] = {}
+
+# Frontmatter only ever holds this fixed set of scalar fields, so the common
+# case is handled by a plain line parser/emitter; yaml.safe_load/safe_dump
+# (pure Python, and by far the hottest cost per read) are kept only as the
+# fallback for hand-edited notes (block scalars, unknown keys, etc.).
+_FRONTMATTER_KEYS = {
+    "branch_id",
+    "title",
+    "parent_branch_id",
+    "fork_from_message",
+    "created_at",
+    "updated_at",
+    "context_summary",
+    "summary_covers_up_to_message",
+}
+
+
+def _parse_frontmatter(text: str) -> Optional[Dict[str, Any]]:
+    """Parse a frontmatter block of simple `key: value` scalar lines.
+
+    Returns None when the block needs the real YAML parser (block scalars,
+    indented continuations, unknown keys).
+    """
+    meta: Dict[str, Any] = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in " \t" or ":" not in line:
+            return None
+        key, value = line.split(":", 1)
+        key = key.strip()
+        if key not in _FRONTMATTER_KEYS:
+            return None
+        value = value.strip()
+        if value and value[0] in "|>":
+            return None
+        if value.startswith('"'):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return None
+        elif len(value) >= 2 and value[0] == "'" and value[-1] == "'":
+            value = value[1:-1]
+        elif value.isdigit() or (value.startswith("-") and value[1:].isdigit()):
+            meta[key] = int(value)
+            continue
+        meta[key] = value
+    return meta
+
+
+def _dump_frontmatter(meta: Dict[str, Any]) -> Optional[str]:
+    """Emit `key: value` lines for simple scalar metadata.
+
+    Returns None when a value needs the real YAML emitter (multiline
+    strings, or any type other than str/int/None).
+    """
+    lines = []
+    for key, value in meta.items():
+        if isinstance(value, str):
+            if "\n" in value:
+                return None
+            if value == "" or value != value.strip() or value[0] in "\"'|>" or ":" in value or "#" in value:
+                value = json.dumps(value, ensure_ascii=False)
+        elif value is None:
+            # A hand-edited empty field (e.g. `fork_from_message:`) loads as
+            # None via the YAML fallback; write it back as empty, not "None".
+            lines.append(f"{key}:")
+            continue
+        elif not isinstance(value, int) or isinstance(value, bool):
+            return None
+        lines.append(f"{key}: {value}")
+    return "\n".join(lines)
+
+
 def _read_branch_file(path: Path) -> Tuple[Dict[str, Any], str]:
     """Read branch file and return (metadata, body)."""
     text = path.read_text(encoding="utf-8")
     if text.startswith("---"):
         parts = text.split("---", 2)
         if len(parts) >= 3:
-            meta = yaml.safe_load(parts[1]) or {}
+            meta = _parse_frontmatter(parts[1])
+            if meta is None:
+                meta = yaml.safe_load(parts[1]) or {}
             body = parts[2].lstrip("\n")
             return meta, body
     return {}, text
 
 
+def _load(path: Path) -> Tuple[Dict[str, Any], str, List[Dict[str, Any]]]:
+    """Read and parse a branch file, reusing the cached parse if unchanged."""
+    st = path.stat()
+    cached = _CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2], cached[3], cached[4]
+
+    meta, body = _read_branch_file(path)
+    messages = parse_messages(body)
+    _CACHE[path] = (st.st_mtime_ns, st.st_size, meta, body, messages)
+    _db.replace_branch(_DB, path.stem, st.st_mtime_ns, st.st_size, meta, messages)
+    return meta, body, messages
+
+
+def _load_meta_messages(path: Path) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Like _load, but for callers that do not need the raw body.
+
+    When the in-memory cache is cold (e.g. right after a restart) but the
+    SQLite mirror still matches the file's stat, the branch is served from
+    indexed rows without reading or parsing the markdown at all.
+    """
+    st = path.stat()
+    cached = _CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2], cached[4]
+
+    row = _db.get_branch(_DB, path.stem)
+    if row is not None and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+        messages = _db.get_messages(_DB, path.stem)
+        if messages is not None:
+            return row[2], messages
+
+    meta, _body, messages = _load(path)
+    return meta, messages
+
+
 def _write_branch_file(path: Path, meta: Dict[str, Any], body: str) -> None:
     """Write branch file with YAML frontmatter and body."""
-    front = "---\n" + yaml.safe_dump(meta, sort_keys=False).strip() + "\n---\n\n"
-    path.write_text(front + body.strip() + "\n", encoding="utf-8")
+    front = _dump_frontmatter(meta)
+    if front is None:
+        front = yaml.safe_dump(meta, sort_keys=False).strip()
+    front = "---\n" + front + "\n---\n\n"
+    body = body.strip() + "\n"
+    # Write to a sibling temp file and rename into place: a crash mid-write
+    # can never leave a truncated branch note, and concurrent rewrites end
+    # up with one complete version instead of interleaved bytes.
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes((front + body).encode("utf-8"))
+    os.replace(tmp, path)
+    # Refresh the cache and the mirror so the next read is a pure stat hit.
+    st = path.stat()
+    messages = parse_messages(body)
+    _CACHE[path] = (st.st_mtime_ns, st.st_size, meta, body, messages)
+    _db.replace_branch(_DB, path.stem, st.st_mtime_ns, st.st_size, meta, messages)
+    # A full rewrite carries the current frontmatter, so nothing is pending.
+    _DIRTY_META.pop(path.stem, None)
 
 
 def _now_iso() -> str:
@@ -96,60 +305,255 @@ def _now_iso() -> str:
 def parse_messages(body: str) -> List[Dict[str, Any]]:
     """
     Parse messages from branch markdown body.
-    
+
     Example:
         ## M1 (User)
         text...
         ## M2 (Assistant)
         ...
+
+    Headers are located with str.find (C-level substring search) instead of
+    the regex engine, and the scanner accepts the same loose inter-token
+    spacing as MSG_HEADER_RE, so strict and hand-edited headers can mix in
+    one file; the regex remains as a last-resort fallback.
     """
+    # Leading sentinel newline lets one search pattern cover a header at
+    # the very start of the body.
+    text = "\n" + body
+    n = len(text)
+    headers: List[Tuple[int, int, str, int]] = []  # (start, m_no, role, line_end)
+    pos = 0
+    ws = " \t\r\f\v"  # intra-line whitespace, mirroring the regex's \s
+    while True:
+        h = text.find("\n##", pos)
+        if h == -1:
+            break
+        i = h + 3
+        j = i
+        while j < n and text[j] in ws:
+            j += 1
+        if j == i or j >= n or text[j] != "M":
+            pos = h + 1
+            continue
+        d = j + 1
+        e = d
+        # Explicit ASCII range: str.isdigit() accepts characters (e.g.
+        # superscripts) that int() rejects and MSG_HEADER_RE never matched.
+        while e < n and "0" <= text[e] <= "9":
+            e += 1
+        if e == d:
+            pos = h + 1
+            continue
+        k = e
+        while k < n and text[k] in ws:
+            k += 1
+        if k == e:
+            pos = h + 1
+            continue
+        if text.startswith("(User)", k):
+            role = _ROLE_USER
+            rest = k + 6
+        elif text.startswith("(Assistant)", k):
+            role = _ROLE_ASSISTANT
+            rest = k + 11
+        else:
+            pos = h + 1
+            continue
+        line_end = text.find("\n", rest)
+        if line_end == -1:
+            line_end = n
+        if text[rest:line_end].strip():
+            # Trailing junk after the role marker: not a header line.
+            pos = h + 1
+            continue
+        headers.append((h, int(text[d:e]), role, line_end))
+        pos = line_end
+
+    if not headers:
+        if MSG_HEADER_RE.search(body):
+            return _parse_messages_re(body)
+        return []
+
+    messages: List[Dict[str, Any]] = []
+    for i, (h, m_no, role, line_end) in enumerate(headers):
+        end = headers[i + 1][0] if i + 1 < len(headers) else n
+        content = text[line_end:end].strip("\n").strip()
+        messages.append({"m": m_no, "role": role, "content": content})
+    return messages
+
+
+def _parse_messages_re(body: str) -> List[Dict[str, Any]]:
+    """Regex fallback for headers the fast scanner does not recognize."""
     matches = list(MSG_HEADER_RE.finditer(body))
     messages: List[Dict[str, Any]] = []
-    
+
     for i, m in enumerate(matches):
         m_no = int(m.group(1))
-        role = "user" if m.group(2).lower() == "user" else "assistant"
+        role = _ROLE_USER if m.group(2) == "User" else _ROLE_ASSISTANT
         start = m.end()
         end = matches[i + 1].start() if i + 1 < len(matches) else len(body)
         content = body[start:end].strip("\n").strip()
         messages.append({"m": m_no, "role": role, "content": content})
-        
+
     return messages
 
 
+# Branches whose frontmatter timestamp is newer in memory than on disk:
+# branch_id -> pending meta. Appends only write the new message bytes; the
+# updated_at patch is coalesced onto a debounce timer (and an atexit hook),
+# so a burst of turns costs one frontmatter write instead of one per message.
+_DIRTY_META: Dict[str, Dict[str, Any]] = {}
+_FLUSH_INTERVAL = float(os.environ.get("TREECHAT_META_FLUSH_SECONDS", "5"))
+_flush_lock = threading.Lock()
+_flush_timer: Optional[threading.Timer] = None
+
+
+def _patch_updated_at(path: Path, updated_at: str) -> bool:
+    """Overwrite the fixed-width `updated_at` value in the frontmatter.
+
+    Returns False when the line is missing or the new value would change
+    width; the caller falls back to a full rewrite.
+    """
+    try:
+        with open(path, "r+b") as f:
+            head = f.read(1024)  # frontmatter always fits in the first block
+            # Bound the search to the frontmatter block: without the fence
+            # check, a body line starting with "updated_at: " in a note that
+            # lacks the frontmatter key would get overwritten in place.
+            if not head.startswith(b"---\n"):
+                return False
+            fence = head.find(b"\n---", 3)
+            if fence == -1:
+                return False
+            key = b"\nupdated_at: "
+            i = head.find(key, 0, fence + 1)
+            if i == -1:
+                return False
+            j = i + len(key)
+            k = head.find(b"\n", j, fence + 1)
+            if k == -1:
+                return False
+            old = head[j:k]
+            new = updated_at.encode("utf-8")
+            if old[:1] in (b"'", b'"'):
+                new = old[:1] + new + old[:1]
+            if len(new) != len(old):
+                return False
+            f.seek(j)
+            f.write(new)
+        return True
+    except OSError:
+        return False
+
+
+def _flush_dirty_meta() -> None:
+    """Write all pending `updated_at` changes to disk."""
+    while _DIRTY_META:
+        branch_id, meta = _DIRTY_META.popitem()
+        path = BRANCH_DIR / f"{branch_id}.md"
+        if not path.exists():
+            continue
+        if _patch_updated_at(path, str(meta.get("updated_at", ""))):
+            st = path.stat()
+            cached = _CACHE.get(path)
+            if cached is not None:
+                _CACHE[path] = (st.st_mtime_ns, st.st_size, meta, cached[3], cached[4])
+            _db.touch_branch(_DB, branch_id, st.st_mtime_ns, st.st_size, meta)
+        else:
+            cached = _CACHE.get(path)
+            body = cached[3] if cached is not None else _read_branch_file(path)[1]
+            _write_branch_file(path, meta, body)
+
+
+def _schedule_meta_flush() -> None:
+    global _flush_timer
+    with _flush_lock:
+        if _flush_timer is None:
+            timer = threading.Timer(_FLUSH_INTERVAL, _run_meta_flush)
+            timer.daemon = True
+            _flush_timer = timer
+            timer.start()
+
+
+def _run_meta_flush() -> None:
+    global _flush_timer
+    with _flush_lock:
+        _flush_timer = None
+    _flush_dirty_meta()
+
+
+atexit.register(_flush_dirty_meta)
+
+
 def append_message(branch_id: str, role: str, content: str) -> Dict[str, Any]:
     """Append a message to a branch."""
+    _require_valid_branch_id(branch_id)
     path = BRANCH_DIR / f"{branch_id}.md"
     if not path.exists():
         raise HTTPException(404, f"Branch not found: {branch_id}")
 
-    meta, body = _read_branch_file(path)
-    msgs = parse_messages(body)
+    meta, body, msgs = _load(path)
+    meta = dict(meta)
     next_m = (msgs[-1]["m"] + 1) if msgs else 1
 
-    header = f"## M{next_m} ({'User' if role=='user' else 'Assistant'})\n"
-    addition = header + content.strip() + "\n\n"
-    body = (body.rstrip() + "\n\n" + addition).lstrip("\n")
+    role = _ROLE_USER if role == "user" else _ROLE_ASSISTANT
+    header = f"## M{next_m} ({'User' if role is _ROLE_USER else 'Assistant'})\n"
+    content = content.strip()
+    stripped = body.strip()
+    body = (stripped + "\n\n" if stripped else "") + header + content + "\n"
 
     # Update the last updated time
     meta["updated_at"] = _now_iso()
-    
-    _write_branch_file(path, meta, body)
-    return {"m": next_m, "role": role, "content": content}
+
+    # The new message is strictly appended to the body, so the common case
+    # only writes the new bytes; the updated_at patch is deferred to the
+    # debounced meta flush instead of rewriting frontmatter per message.
+    chunk = ("\n" + header + content + "\n").encode("utf-8")
+    try:
+        with open(path, "ab") as f:
+            f.write(chunk)
+    except OSError:
+        _write_branch_file(path, meta, body)
+        return {"m": next_m, "role": role, "content": content}
+
+    message = {"m": next_m, "role": role, "content": content}
+    st = path.stat()
+    _CACHE[path] = (st.st_mtime_ns, st.st_size, meta, body, msgs + [message])
+    _db.append_message(_DB, branch_id, message, st.st_mtime_ns, st.st_size, meta)
+    _DIRTY_META[branch_id] = meta
+    _schedule_meta_flush()
+    return message
 
 
 # ----------------------------
 # Branch Operations
 # ----------------------------
 def list_branches() -> List[Dict[str, Any]]:
-    """List all branches with their metadata."""
+    """List all branches with their metadata.
+
+    One scandir pass over the branch directory: entries whose stat still
+    matches the SQLite mirror are served from the stored metadata without
+    opening the file; only new or changed files get parsed.
+    """
+    rows = _db.all_branches(_DB) or {}
+    with os.scandir(BRANCH_DIR) as it:
+        entries = sorted(
+            (e for e in it if e.name.endswith(".md")), key=lambda e: e.name
+        )
+
     out: List[Dict[str, Any]] = []
-    for f in sorted(BRANCH_DIR.glob("*.md")):
-        meta, _body = _read_branch_file(f)
-        meta = meta or {}
+    for entry in entries:
+        st = entry.stat()
+        row = rows.get(entry.name[:-3])
+        if row is not None and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            meta = dict(row[2])
+        else:
+            meta, _msgs = _load_meta_messages(Path(entry.path))
+            meta = dict(meta) if meta else {}
         # Normalize metadata
-        meta.setdefault("branch_id", f.stem)
-        meta.setdefault("title", f.stem)
+        stem = entry.name[:-3]
+        meta.setdefault("branch_id", stem)
+        meta.setdefault("title", stem)
         meta.setdefault("parent_branch_id", "")
         meta.setdefault("fork_from_message", "")
         meta.setdefault("created_at", "")
@@ -159,12 +563,12 @@ def list_branches() -> List[Dict[str, Any]]:
 
 def get_branch(branch_id: str) -> Dict[str, Any]:
     """Get a single branch with its messages."""
+    _require_valid_branch_id(branch_id)
     path = BRANCH_DIR / f"{branch_id}.md"
     if not path.exists():
         raise HTTPException(404, f"Branch not found: {branch_id}")
         
-    meta, body = _read_branch_file(path)
-    msgs = parse_messages(body)
+    meta, msgs = _load_meta_messages(path)
     return {"meta": meta or {}, "messages": msgs}
 
 
@@ -193,40 +597,66 @@ def create_branch(
     return meta
 
 
+def _sync_branch_dir() -> None:
+    """Bring the SQLite mirror up to date with the branch directory.
+
+    One scandir pass comparing stats: only new or externally-edited files
+    are re-parsed, and rows for files deleted outside the app are dropped.
+    """
+    rows = _db.all_branches(_DB)
+    if rows is None:
+        return
+    seen = set()
+    with os.scandir(BRANCH_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith(".md"):
+                continue
+            branch_id = entry.name[:-3]
+            seen.add(branch_id)
+            st = entry.stat()
+            row = rows.get(branch_id)
+            if row is None or row[0] != st.st_mtime_ns or row[1] != st.st_size:
+                _load(Path(entry.path))
+    for branch_id in rows.keys() - seen:
+        _db.delete_branch(_DB, branch_id)
+
+
 def delete_branch(branch_id: str, delete_artifacts: bool = True) -> None:
-    """Delete a branch and optionally its artifacts."""
+    """Delete a branch, its children recursively, and optionally artifacts."""
+    _require_valid_branch_id(branch_id)
     path = BRANCH_DIR / f"{branch_id}.md"
     if not path.exists():
         raise HTTPException(404, f"Branch not found: {branch_id}")
 
+    # One sync up front, then every child lookup in the subtree is an
+    # indexed query instead of re-reading every branch file per node.
+    _sync_branch_dir()
+    _delete_branch_tree(branch_id, delete_artifacts)
+
+
+def _delete_branch_tree(branch_id: str, delete_artifacts: bool) -> None:
+    path = BRANCH_DIR / f"{branch_id}.md"
+
     # Delete all children recursively
-    branches = list_branches()
-    children = [b["branch_id"] for b in branches if (b.get("parent_branch_id") or "") == branch_id]
+    children = _db.children(_DB, branch_id)
+    if children is None:
+        # Mirror unavailable: fall back to scanning all branches.
+        branches = list_branches()
+        children = [b["branch_id"] for b in branches if (b.get("parent_branch_id") or "") == branch_id]
     for child_id in children:
-        delete_branch(child_id, delete_artifacts=delete_artifacts)
+        _delete_branch_tree(child_id, delete_artifacts)
 
     # Delete the branch file
-    path.unlink()
+    if path.exists():
+        path.unlink()
+    _CACHE.pop(path, None)
+    _CTX_CACHE.pop(branch_id, None)
+    _DIRTY_META.pop(branch_id, None)
+    _db.delete_branch(_DB, branch_id)
     
     # Delete artifacts if requested
     if delete_artifacts:
-        art_dir = ARTIFACT_DIR / branch_id
-        if art_dir.exists():
-            # Delete all files in the artifact directory
-            for p in art_dir.glob("**/*"):
-                if p.is_file():
-                    p.unlink()
-            # Remove empty directories
-            for p in sorted(art_dir.glob("**/*"), reverse=True):
-                if p.is_dir():
-                    try:
-                        p.rmdir()
-                    except OSError:
-                        pass
-            try:
-                art_dir.rmdir()
-            except OSError:
-                pass
+        shutil.rmtree(ARTIFACT_DIR / branch_id, ignore_errors=True)
 
 
 # ----------------------------
@@ -251,20 +681,92 @@ def _apply_summary_checkpoint(meta: Dict[str, Any], messages: List[Dict[str, Any
     except (ValueError, TypeError):
         return messages
 
-    remaining = [m for m in messages if m["m"] > covers_n]
     summary_msg = {
-        "m": covers_n, 
-        "role": "assistant", 
+        "m": covers_n,
+        "role": "assistant",
         "content": f"(Summary)\n{summary}"
     }
-    return [summary_msg] + remaining
+    # Messages are kept sorted by m (append order), so the cutoff is a
+    # binary search plus one slice instead of a linear filter.
+    idx = bisect_right(messages, covers_n, key=itemgetter("m"))
+    return [summary_msg, *messages[idx:]]
+
+
+# Memoized parent prefix per branch: branch_id -> (key, prefix messages).
+# The parent portion of a context is stable between replies (append-only
+# history), so it is rebuilt only when the parent file's mtime changes.
+# Keeping the prefix byte-identical across calls also helps provider-side
+# prompt caching downstream.
+_CTX_CACHE: Dict[str, Tuple[Tuple[Any, ...], List[Dict[str, str]]]] = {}
 
 
-def build_context(branch_id: str) -> List[Dict[str, str]]:
+def _parent_prefix(branch_id: str, parent_id: str, fork_from: Any) -> List[Dict[str, str]]:
+    """Ancestor messages down to this branch's fork point, in OpenAI format.
+
+    Walks the whole parent chain iteratively (no recursion), trimming each
+    ancestor at the fork point of the branch below it, and prepends level
+    by level onto a deque — so a deep fork chain sees root history too,
+    not just the immediate parent. The result is memoized per branch,
+    keyed by each ancestor's (id, mtime_ns, fork point); building the key
+    costs one stat plus a cache lookup per level.
+    """
+    # Collect the chain child-most first: (meta, messages, fork point below).
+    chain: List[Tuple[Dict[str, Any], List[Dict[str, Any]], Any]] = []
+    key_parts: List[Tuple[str, int, Any]] = []
+    pid, ff = parent_id, fork_from
+    seen = set()
+    while pid and pid not in seen:
+        seen.add(pid)
+        path = BRANCH_DIR / f"{pid}.md"
+        if not path.exists():
+            raise HTTPException(404, f"Branch not found: {pid}")
+        key_parts.append((pid, path.stat().st_mtime_ns, ff))
+        meta, msgs = _load_meta_messages(path)
+        meta = meta or {}
+        chain.append((meta, msgs, ff))
+        pid = (meta.get("parent_branch_id") or "").strip()
+        ff = meta.get("fork_from_message")
+
+    key = tuple(key_parts)
+    hit = _CTX_CACHE.get(branch_id)
+    if hit is not None and hit[0] == key:
+        return hit[1]
+
+    prefix: deque = deque()
+    for meta, msgs, fork in chain:
+        msgs = _apply_summary_checkpoint(meta, msgs)
+        if fork:
+            try:
+                cutoff = int(fork)
+            except (ValueError, TypeError):
+                pass
+            else:
+                msgs = msgs[: bisect_right(msgs, cutoff, key=itemgetter("m"))]
+        prefix.extendleft(
+            {"role": m["role"], "content": m["content"]}
+            for m in reversed(msgs)
+            if m.get("content")
+        )
+
+    result = list(prefix)
+    _CTX_CACHE[branch_id] = (key, result)
+    return result
+
+
+def build_context(branch_id: str, cache_control: bool = False) -> List[Dict[str, str]]:
     """
     Build context array for OpenAI API calls.
-    
+
     Context is built as: context(parent up to fork point) + messages(current branch)
+
+    The list is [SYSTEM_DICT, *parent prefix, *own messages]. Provider-side
+    prompt caching keys on exact prefix identity, so the system message and
+    the parent prefix are deliberately byte-stable between replies: no
+    timestamps, fixed dict key order, same cached objects every call.
+
+    With cache_control=True (Anthropic-style backends), the last parent
+    message is marked with cache_control: ephemeral so the provider caches
+    the stable prefix; the cached dicts themselves are never mutated.
     """
     data = get_branch(branch_id)
     meta: Dict[str, Any] = data["meta"] or {}
@@ -273,31 +775,40 @@ def build_context(branch_id: str) -> List[Dict[str, str]]:
     parent_id = (meta.get("parent_branch_id") or "").strip()
     fork_from = meta.get("fork_from_message")
 
-    if not parent_id:
-        combined = my_msgs
-    else:
-        parent = get_branch(parent_id)
-        parent_meta = parent["meta"] or {}
-        parent_msgs = _apply_summary_checkpoint(parent_meta, parent["messages"])
-
-        if fork_from:
-            try:
-                cutoff = int(fork_from)
-                parent_msgs = [m for m in parent_msgs if m["m"] <= cutoff]
-            except (ValueError, TypeError):
-                pass
-
-        # For v0, we use a simple approach: parent messages up to fork point + current branch messages
-        combined = parent_msgs + my_msgs
-
-    # Convert to OpenAI format with system prompt
-    out: List[Dict[str, str]] = [{"role": "system", "content": SYSTEM_PROMPT}]
+    # Convert to OpenAI format with system prompt; the system dict and the
+    # memoized parent prefix are reused by reference, so only this branch's
+    # own messages allocate per call.
+    out: List[Dict[str, str]] = list(_SYSTEM_PREFIX)
+    if parent_id:
+        base = len(out)
+        out.extend(_parent_prefix(branch_id, parent_id, fork_from))
+        if cache_control and len(out) > base:
+            out[-1] = {**out[-1], "cache_control": {"type": "ephemeral"}}
     out.extend(
         {"role": m["role"], "content": m["content"]}
-        for m in combined
+        for m in my_msgs
         if m.get("content")
     )
-    return out
+    return _trim_to_budget(out)
+
+
+def _trim_to_budget(out: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Drop oldest unpinned messages until the context fits the token budget.
+
+    The pinned prefix is always kept, and so is the newest message.
+    Trimming removes from the front of the history, so while the context
+    is within budget nothing changes and the prompt prefix stays stable.
+    """
+    total = sum(_token_count(m["content"]) for m in out)
+    if total <= MAX_CONTEXT_TOKENS:
+        return out
+
+    pinned = len(_SYSTEM_PREFIX)
+    i = pinned
+    while i < len(out) - 1 and total > MAX_CONTEXT_TOKENS:
+        total -= _token_count(out[i]["content"])
+        i += 1
+    return [*out[:pinned], *out[i:]]
 
 
 def build_message_chain(branch_id: str) -> List[Dict[str, Any]]: